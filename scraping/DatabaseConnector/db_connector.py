@@ -66,6 +66,48 @@ class DatabaseConnector:
             print(ex)
             print("Record not inserted")
 
+    # Same as insert_news_article, but records go in batches of one executemany and one commit
+    # batch_size keeps the multi-row statement under max_allowed_packet with full article content
+    def insert_news_articles(self, data_dicts, table_name, batch_size=50):
+        if not table_name:
+            raise ValueError("db_connector insert_news_articles missing table_name")
+        mycursor = self.mydb.cursor()
+        sql = "INSERT INTO {} (title, description, author, url, content, urlToImage, publishedAt, addedOn, siteName, language, countryCode, status) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) ON DUPLICATE KEY UPDATE title = VALUES(title), description = VALUES(description), author = VALUES(author), content = VALUES(content), urlToImage = VALUES(urlToImage), publishedAt = VALUES(publishedAt), addedOn = VALUES(addedOn), siteName = VALUES(siteName), language = VALUES(language), countryCode = VALUES(countryCode)".format(
+            table_name
+        )
+        for start in range(0, len(data_dicts), batch_size):
+            batch = data_dicts[start : start + batch_size]
+            vals = [
+                (
+                    data_dict["title"],
+                    data_dict["description"],
+                    data_dict["author"],
+                    data_dict["url"],
+                    data_dict["content"],
+                    data_dict["urlToImage"],
+                    data_dict["publishedAt"],
+                    data_dict["addedOn"],
+                    data_dict["siteName"],
+                    data_dict["language"],
+                    data_dict["countryCode"],
+                    1,  # Status
+                )
+                for data_dict in batch
+            ]
+            print("SQL query: ", sql, "records: ", len(vals))
+            try:
+                mycursor.executemany(sql, vals)
+                self.mydb.commit()
+                print(mycursor.rowcount, "record(s) inserted.")
+            except Exception as ex:
+                self.mydb.rollback()
+                print(ex)
+                # one bad record (eg: too long, unsupported characters) fails the whole batch,
+                # retry one by one so only that record is lost
+                print("Batch not inserted, inserting records one by one")
+                for data_dict in batch:
+                    self.insert_news_article(data_dict, table_name)
+
     # worldometers TABLE_SCHEMA
     # country, total_cases, total_deaths, total_recovered, total_tests, new_cases, new_deaths, active_cases, serious_critical_cases, total_cases_per_million_pop, total_tests_per_million_pop, last_updated
     def insert_worldometer_stats(self, data_dict, table_name):
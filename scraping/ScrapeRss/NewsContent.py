@@ -1,3 +1,6 @@
+from ScrapeRss.helpers import valid_dt_value
+
+
 class NewsContent:
     def __init__(
         self,
@@ -14,3 +17,12 @@ class NewsContent:
         self.description = description
         self.published_at = published_at
         self.seed_source = seed_source
+
+    def has_feed_data(self):
+        # title, description and publish date all came from the seed page
+        return bool(
+            self.title
+            and self.description
+            and self.published_at
+            and valid_dt_value(self.published_at)
+        )
@@ -1,18 +1,25 @@
 from ScrapeRss.NewsContent import NewsContent
 
 from ScrapeRss.globals import URL_BLACKLIST_KEYWORDS, CORONA_KEYWORDS
-from ScrapeRss.globals import SEED_QUEUE, EXTRACT_QUEUE
+from ScrapeRss.globals import CACHE
 
 from ScrapeRss.helpers import is_valid_url, is_article_uploaded_today
 from ScrapeRss.helpers import get_title_from_for_html, get_description_from_for_html
 from ScrapeRss.helpers import corona_keyword_exists_in_string
 from ScrapeRss.helpers import convert_date_to_datetime_object
+from ScrapeRss.helpers import find_node_text
 
 
-from bs4 import BeautifulSoup
+from lxml import etree
+import lxml.html
 import logging
 import re
 
+# common nodes for sitemaps, with the parent they're expected under
+# (rss <channel><image><url> shouldn't be treated as a sitemap entry)
+XML_NODE_TAGS = ("{*}item", "{*}url", "{*}sitemap", "lastBuildDate")
+XML_NODE_PARENTS = {"url": "urlset", "sitemap": "sitemapindex"}
+
 
 class NewsParser:
     def __init__(
@@ -20,17 +27,19 @@ class NewsParser:
         locale="",
         root_url="",
         schema={},
-        soup_page="",
+        last_build_date=None,
         is_xml=True,
         news_list=[],
+        seed_list=[],
         custom_blacklist=[],
     ):
         self.locale = locale
         self.root_url = root_url
         self.schema = schema
-        self.soup_page = soup_page
+        self.last_build_date = last_build_date
         self.is_xml = is_xml
-        self.news_list = news_list
+        self.news_list = list(news_list)
+        self.seed_list = list(seed_list)
         self.custom_blacklist = set(custom_blacklist)
 
         self.parse_schema()
@@ -43,6 +52,17 @@ class NewsParser:
                 set(self.schema["custom_blacklist"])
             )
 
+        # resolve the schema's tag names once per seed, not once per node
+        # None when the sitemap doesn't have that field
+        self.url_tag = self.schema.get("url")
+        self.title_tag = self.schema.get("title")
+        self.description_tag = self.schema.get("description")
+        self.keywords_tag = self.schema.get("keywords")
+        self.author_tag = self.schema.get("author")
+        self.date_tag = None
+        if "date_xml" in self.schema:
+            self.date_tag = self.schema["date_xml"][0]
+
     def validate_required_values(self):
         error = False
         if not self.root_url.strip():
@@ -57,12 +77,15 @@ class NewsParser:
                 "NewsParser object missing required attributes: root_url, locale"
             )
 
-    def parse_seed_page_content(self, page_content):
-        news_list = []
+    def parse_seed_page_content(self, page_content, encoding=None):
+        # page_content is a file-like object, parsed as it's being read
         # Attempt to crawl non xml sites
         if not self.is_xml:
-            self.soup_page = BeautifulSoup(page_content, "html.parser")
-            self.parse_soup_page_for_html()
+            # lxml falls back to Latin-1 for html without a <meta charset>
+            html_parser = lxml.html.HTMLParser(encoding=encoding)
+            html_page = lxml.html.parse(page_content, html_parser).getroot()
+            if html_page is not None:
+                self.parse_page_for_html(html_page)
 
         else:
             # xml sites, extract each nodes. Node format example:
@@ -72,14 +95,13 @@ class NewsParser:
             #     </loc>
             #     <lastmod>2020-02-15</lastmod>
             # </url>
-            self.soup_page = BeautifulSoup(page_content, "xml")
-            self.parse_soup_page_for_xml()
+            self.parse_page_for_xml(page_content)
 
-    def parse_soup_page_for_html(self):
-        for a_tag_node in self.soup_page.findAll("a"):
+    def parse_page_for_html(self, html_page):
+        for a_tag_node in html_page.iter("a"):
             include_url = True
 
-            url = a_tag_node.text.strip()
+            url = a_tag_node.text_content().strip()
             title = get_title_from_for_html(a_tag_node)
             description = get_description_from_for_html(a_tag_node)
 
@@ -97,9 +119,8 @@ class NewsParser:
                 continue
 
             news_object = NewsContent(seed_source=self)
-            try:
-                news_object.news_url = a_tag_node["href"]
-            except Exception as e:
+            news_object.news_url = a_tag_node.get("href")
+            if not news_object.news_url or news_object.news_url in CACHE:
                 continue
 
             if not is_valid_url(news_object.news_url, self.custom_blacklist):
@@ -107,100 +128,123 @@ class NewsParser:
 
             self.news_list.append(news_object)
 
-    def parse_soup_page_for_xml(self):
-        # common nodes for sitemaps
-        # hardcode? or set in schema?
-        url_nodes = self.soup_page.findAll("item")
-        if not url_nodes:
-            url_nodes = self.soup_page.findAll("url")
-        if not url_nodes:
-            url_nodes = self.soup_page.findAll("sitemap")
-
-        for node in url_nodes:
-            insert_article = True
-            news_object = NewsContent(seed_source=self)
-            published_at_dt_object = None
-            # use date_xml in schema to skip old articles and get published_at
-            if "date_xml" in self.schema:
-                date_tag_name = self.schema["date_xml"][0]
-                date_value_dt_format = self.schema["date_xml"][1]
-
-                try:
-                    date_string_value = node.find(date_tag_name).text
-                    published_at_dt_object = convert_date_to_datetime_object(
-                        date_string_value
-                    )
-                    insert_article = is_article_uploaded_today(published_at_dt_object)
-                except Exception as e:
-                    # Potentially sub-sitemap doesn't have datetime even though root sitemap does
-                    # "Fail to convert extract date_tag_name. Most likely irregular xml format. date_tag_name: {}, Node: {} Skipping..."
-                    # "Fail to convert publishedAt datetime format. Most likely irregular xml format. Value: {}, Format: {} Skipping..."
-                    # logging.error("Fail to convert extract date_tag_name or publishedAt datetime format. Skip early catching. URL: {}".format(self.root_url))
-                    insert_article = True
-
-            # if datetime exists, use it for early catching
-            #   skip if article is not uploaded today
-            # else proceed to try other methods
-            if not insert_article:
-                continue
-
-            # check for xml to feed back into SEED_QUEUE
-            news_url = node.find(self.schema["url"]).text.strip()
-            check_url = news_url[: news_url.index("?")] if "?" in news_url else news_url
-            if check_url.endswith(".xml"):
-                seed_object = NewsParser(
-                    locale=self.locale, root_url=news_url, schema=self.schema,
-                )
-                SEED_QUEUE.put(seed_object)
-                continue
-
-            # check for empty, non https ,blacklist
-            if not is_valid_url(news_url, self.custom_blacklist):
-                logging.debug(
-                    "url: {}, check: is_valid_url, valid: False".format(news_url)
-                )
-                continue
+    def parse_page_for_xml(self, xml_page):
+        # iterparse keeps the parsing in libxml2 and lets us drop each node
+        # once it's processed, instead of holding the whole tree in memory
+        context = etree.iterparse(
+            xml_page,
+            events=("end",),
+            tag=XML_NODE_TAGS,
+            huge_tree=True,
+            recover=True,
+        )
+        try:
+            for _, node in context:
+                tag_name = etree.QName(node).localname
+                if tag_name == "lastBuildDate":
+                    self.last_build_date = node.text
+                    continue
 
-            node_title = ""
-            node_description = ""
-            if "title" not in self.schema and "description" not in self.schema:
-                # sitemap doesn't have title or description at all
-                # so we have to go through each URL to check if CORONA_KEYWORDS exists
-                pass
-            elif "keywords" in self.schema:
-                keywords_node = node.find(self.schema["keywords"])
-                if keywords_node:
-                    keywords = keywords_node.text
-                    if not corona_keyword_exists_in_string(keywords.lower()):
-                        continue
-            else:
-                # sitemap that contains either title or description
-                # early detection if URL contains CORONA_KEYWORDS or not
-                if "title" in self.schema:
-                    title_node = node.find(self.schema["title"])
-                    node_title = title_node.text if title_node else node_title
-
-                if "description" in self.schema:
-                    node_description = node.find(self.schema["description"]).text
-
-                # check if any of the CORONA_KEYWORDS occur in title or description
-                corona_keywords_exist = corona_keyword_exists_in_string(
-                    node_title.lower()
-                ) or corona_keyword_exists_in_string(node_description.lower())
-                if not corona_keywords_exist:
+                parent = node.getparent()
+                if (
+                    tag_name in XML_NODE_PARENTS
+                    and parent is not None
+                    and etree.QName(parent).localname != XML_NODE_PARENTS[tag_name]
+                ):
                     continue
 
-            node_author = ""
-            if "author" in self.schema:
-                node_author = node.find(self.schema["author"]).text
+                self.parse_xml_node(node)
 
-            news_object.author = node_author
-            news_object.news_url = news_url
-            news_object.title = node_title
-            news_object.description = node_description
-            news_object.published_at = published_at_dt_object
-            self.news_list.append(news_object)
+                node.clear()
+                while node.getprevious() is not None:
+                    del node.getparent()[0]
+        except etree.XMLSyntaxError as e:
+            logging.error("Fail to parse xml: %s. Error: %s", self.root_url, e)
+
+    def parse_xml_node(self, node):
+        insert_article = True
+        news_object = NewsContent(seed_source=self)
+        published_at_dt_object = None
+        # use date_xml in schema to skip old articles and get published_at
+        if self.date_tag is not None:
+            try:
+                date_string_value = find_node_text(node, self.date_tag)
+                published_at_dt_object = convert_date_to_datetime_object(
+                    date_string_value
+                )
+                insert_article = is_article_uploaded_today(published_at_dt_object)
+            except Exception as e:
+                # Potentially sub-sitemap doesn't have datetime even though root sitemap does
+                # "Fail to convert extract date_tag_name. Most likely irregular xml format. date_tag_name: {}, Node: {} Skipping..."
+                # "Fail to convert publishedAt datetime format. Most likely irregular xml format. Value: {}, Format: {} Skipping..."
+                # logging.error("Fail to convert extract date_tag_name or publishedAt datetime format. Skip early catching. URL: {}".format(self.root_url))
+                insert_article = True
+
+        # if datetime exists, use it for early catching
+        #   skip if article is not uploaded today
+        # else proceed to try other methods
+        if not insert_article:
+            return
+
+        news_url = find_node_text(node, self.url_tag)
+        if news_url is None:
+            return
+
+        # check for xml to feed back as a new seed
+        news_url = news_url.strip()
+        check_url = news_url[: news_url.index("?")] if "?" in news_url else news_url
+        if check_url.endswith(".xml"):
+            seed_object = NewsParser(
+                locale=self.locale, root_url=news_url, schema=self.schema,
+            )
+            self.seed_list.append(seed_object)
+            return
+
+        # skip already extracted urls before doing any more work on them
+        if news_url in CACHE:
+            return
+
+        # check for empty, non https ,blacklist
+        if not is_valid_url(news_url, self.custom_blacklist):
+            logging.debug("url: %s, check: is_valid_url, valid: False", news_url)
+            return
+
+        node_title = ""
+        node_description = ""
+        if self.title_tag is None and self.description_tag is None:
+            # sitemap doesn't have title or description at all
+            # so we have to go through each URL to check if CORONA_KEYWORDS exists
+            pass
+        elif self.keywords_tag is not None:
+            keywords = find_node_text(node, self.keywords_tag)
+            if keywords is not None:
+                if not corona_keyword_exists_in_string(keywords):
+                    return
+        else:
+            # sitemap that contains either title or description
+            # early detection if URL contains CORONA_KEYWORDS or not
+            if self.title_tag is not None:
+                node_title = find_node_text(node, self.title_tag, node_title)
+
+            if self.description_tag is not None:
+                node_description = find_node_text(
+                    node, self.description_tag, node_description
+                )
 
-    def add_news_to_extraction_queue(self):
-        for news_object in self.news_list:
-            EXTRACT_QUEUE.put(news_object)
+            # check if any of the CORONA_KEYWORDS occur in title or description
+            corona_keywords_exist = corona_keyword_exists_in_string(
+                node_title
+            ) or corona_keyword_exists_in_string(node_description)
+            if not corona_keywords_exist:
+                return
+
+        node_author = ""
+        if self.author_tag is not None:
+            node_author = find_node_text(node, self.author_tag, node_author)
+
+        news_object.author = node_author
+        news_object.news_url = news_url
+        news_object.title = node_title
+        news_object.description = node_description
+        news_object.published_at = published_at_dt_object
+        self.news_list.append(news_object)
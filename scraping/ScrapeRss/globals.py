@@ -1,9 +1,5 @@
 # CONSTANT VALUES
 
-import queue
-
-SEED_QUEUE = queue.Queue()
-EXTRACT_QUEUE = queue.Queue()
 RSS_STACK = {}
 CACHE = set()
 
@@ -66,10 +62,18 @@ SPECIAL_LANG = {
 }
 
 CACHE_FILE = "cache.txt"
+CACHE_BUFFER_SIZE = 1 << 16
 OUTPUT_FILENAME = "output.jsonl"
 THREAD_LIMIT = 10
+# extract workers spend most of their time waiting on article downloads
+EXTRACT_THREAD_LIMIT = 32
 THREAD_TIMEOUT = 180  # seconds
 REQUEST_TIMEOUT = 10
+# keep enough pooled connections per host for every worker thread
+POOL_CONNECTIONS = 32
+POOL_MAXSIZE = 64
+REQUEST_RETRIES = 2
+DOMAIN_CRAWL_DELAY = 1.5  # seconds between article requests to the same domain
 HEADER = {
     "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_5) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/50.0.2661.102 Safari/537.36"
 }
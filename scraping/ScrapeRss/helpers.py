@@ -6,17 +6,57 @@ from ScrapeRss.globals import (
     ISO_8601_DATE_FORMAT,
 )
 from ScrapeRss.globals import REQUEST_TIMEOUT, HEADER
+from ScrapeRss.globals import POOL_CONNECTIONS, POOL_MAXSIZE, REQUEST_RETRIES
+from ScrapeRss.globals import DOMAIN_CRAWL_DELAY
 
 from newspaper import Article
+from lxml import etree
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from datetime import datetime, timezone
+from email.message import Message
 from dateutil import parser
+from urllib.parse import urlsplit
+from urllib.robotparser import RobotFileParser
+import functools
+import threading
 import logging
 import requests
+import time
 import re
 
 TODAY_TIME = datetime.now()
 
+# compiled once, these run for every url and article
+URL_SCHEME_REGEX = re.compile(r"^https?://", re.IGNORECASE)
+SITE_NAME_REGEX = re.compile(r"https?://(www\.)?")
+CORONA_KEYWORDS_REGEX = re.compile(
+    "|".join(re.escape(keyword) for keyword in CORONA_KEYWORDS), re.IGNORECASE
+)
+
+# first node whose qualified name (eg: news:title) or local name (eg: title
+# also matches <news:title>) is the schema tag, so schemas don't need
+# namespace uris. Same matching as BeautifulSoup's xml find
+NODE_FINDER = etree.XPath("(.//*[name()=$name or local-name()=$name])[1]")
+
+# Shared across threads so seed pages and articles reuse pooled
+# keep-alive connections instead of a new TCP/TLS handshake per request
+SESSION = requests.Session()
+SESSION.headers.update(HEADER)
+_adapter = HTTPAdapter(
+    pool_connections=POOL_CONNECTIONS,
+    pool_maxsize=POOL_MAXSIZE,
+    max_retries=Retry(total=REQUEST_RETRIES, backoff_factor=0.3),
+)
+SESSION.mount("http://", _adapter)
+SESSION.mount("https://", _adapter)
+
+# Per domain politeness, shared by all extract workers
+ROBOTS_PARSERS = {}
+LAST_DOMAIN_HIT = {}
+DOMAIN_LOCKS = {}
+
 
 def is_valid_url(url, blacklist):
     # not empty
@@ -30,9 +70,7 @@ def is_valid_url(url, blacklist):
     # logging.debug("URL: {}. DOMAIN: {}, ROOT_DOMAIN: {}".format(url, domain, root_domain))
 
     # missing http(s):// or contain blacklist
-    if not re.findall(
-        r"^https?://", url, re.IGNORECASE
-    ) or is_blacklist_keywords_in_url(url, blacklist):
+    if not URL_SCHEME_REGEX.match(url) or is_blacklist_keywords_in_url(url, blacklist):
         return False
     return True
 
@@ -46,41 +84,71 @@ def is_blacklist_keywords_in_url(url, blacklist):
 
 
 def get_title_from_for_html(node):
-    title = node.find("title")
-    if not title:
-        title = node.find("h1")
-    if not title:
-        title = node.find("h2")
-    return title.text if title else ""
+    title = node.find(".//title")
+    if title is None:
+        title = node.find(".//h1")
+    if title is None:
+        title = node.find(".//h2")
+    return title.text_content() if title is not None else ""
 
 
 def get_description_from_for_html(node):
-    description = node.find("p")
-    return description.text if description else ""
+    description = node.find(".//p")
+    return description.text_content() if description is not None else ""
+
+
+def find_node_text(node, tag_name, default=None):
+    found = NODE_FINDER(node, name=tag_name)
+    if not found:
+        return default
+    return "".join(found[0].itertext())
+
+
+def get_source_url(url):
+    split_url = urlsplit(url)
+    return "{}://{}".format(split_url.scheme, split_url.netloc)
 
 
-def get_seed_page(url):
+# source_url is one of a few dozen site roots per run
+@functools.lru_cache(maxsize=64)
+def get_site_name(source_url):
+    return SITE_NAME_REGEX.sub("", source_url, count=1)
+
+
+def get_header_charset(res):
+    # only trust a charset the server actually sent, requests would otherwise
+    # assume ISO-8859-1 for any text/html response
+    header = Message()
+    header["content-type"] = res.headers.get("content-type", "")
+    return header.get_content_charset()
+
+
+def get_response_encoding(res):
+    charset = get_header_charset(res)
+    if charset:
+        return charset
+    # no charset in the header, guess from the body like BeautifulSoup used to
+    return res.apparent_encoding
+
+
+def get_seed_page(url, stream=False):
     try:
-        logging.debug("Get seed url: {}".format(url))
-        res = requests.get(url, headers=HEADER, timeout=REQUEST_TIMEOUT)
+        logging.debug("Get seed url: %s", url)
+        res = SESSION.get(url, timeout=REQUEST_TIMEOUT, stream=stream)
+        if stream:
+            # let the parser read the decompressed body straight off the socket
+            res.raw.decode_content = True
         return res
     except Exception as e:
-        logging.error("Fail to get url: {}".format(url))
+        logging.error("Fail to get url: %s", url)
         raise e
 
 
 def corona_keyword_exists_in_string(string):
-    # this works well if for words that are split by space/comma
-    # fails for languages that doesn't need space/comma
-    # hence, do brute force to check keyword in string
+    # search for the keywords as substrings rather than splitting into words,
+    # as that fails for languages that doesn't need space/comma
     # eg: 武漢肺炎中國確診逾, where 武漢肺炎 is coronavirus
-    if len(set(re.findall(r"\w+", string)).intersection(CORONA_KEYWORDS)) != 0:
-        return True
-    # Fallback: if can't find, search each keyword in string, brute force
-    for keyword in CORONA_KEYWORDS:
-        if keyword in string:
-            return True
-    return False
+    return CORONA_KEYWORDS_REGEX.search(string) is not None
 
 
 def valid_dt_value(dt_object):
@@ -94,18 +162,18 @@ def valid_dt_value(dt_object):
 
 def attempt_extract_from_meta_data(meta_data, attribute, original_value):
     logging.debug(
-        "Start attempt look for attribute: {}. Original value: {}".format(
-            attribute, original_value if original_value else "None"
-        )
+        "Start attempt look for attribute: %s. Original value: %s",
+        attribute,
+        original_value if original_value else "None",
     )
     if attribute not in meta_data:
         return ""
 
     if attribute in meta_data and isinstance(meta_data[attribute], str):
         logging.debug(
-            "Found attribute: {} in meta_data. value: {}".format(
-                attribute, meta_data[attribute]
-            )
+            "Found attribute: %s in meta_data. value: %s",
+            attribute,
+            meta_data[attribute],
         )
         return meta_data[attribute]
 
@@ -116,9 +184,9 @@ def attempt_extract_from_meta_data(meta_data, attribute, original_value):
         and len(meta_data["og"][attribute].strip())
     ):
         logging.debug(
-            "Found attribute: {} in og. value: {}".format(
-                attribute, meta_data["og"][attribute]
-            )
+            "Found attribute: %s in og. value: %s",
+            attribute,
+            meta_data["og"][attribute],
         )
         return meta_data["og"][attribute]
 
@@ -129,17 +197,15 @@ def attempt_extract_from_meta_data(meta_data, attribute, original_value):
         and len(meta_data["article"][attribute].strip())
     ):
         logging.debug(
-            "Found attribute: {} in article. value: {}".format(
-                attribute, meta_data["article"][attribute]
-            )
+            "Found attribute: %s in article. value: %s",
+            attribute,
+            meta_data["article"][attribute],
         )
         return meta_data["article"][attribute]
 
     # if all fails, return default value
     logging.debug(
-        "Fail to find attribute: {} using default value: {}".format(
-            attribute, original_value
-        )
+        "Fail to find attribute: %s using default value: %s", attribute, original_value
     )
     return original_value
 
@@ -147,12 +213,13 @@ def attempt_extract_from_meta_data(meta_data, attribute, original_value):
 def convert_date_to_datetime_object(date_string):
     if not isinstance(date_string, str):
         # could already be a datetime object as initial value extracted in NewsParser
+        utc_date = date_string.astimezone(timezone.utc)
         logging.debug(
-            "Input date already in datetime value: {}. UTC: {}. Skipping convertion...".format(
-                date_string, date_string.astimezone(timezone.utc)
-            )
+            "Input date already in datetime value: %s. UTC: %s. Skipping convertion...",
+            date_string,
+            utc_date,
         )
-        return date_string.astimezone(timezone.utc)
+        return utc_date
     return parser.parse(date_string).astimezone(timezone.utc)
 
 
@@ -175,7 +242,7 @@ def get_title_from_article(article, news_object):
     return attempt_extract_from_meta_data(article.meta_data, "title", news_object.title)
 
 
-def get_published_at_value(published_at_dt_object, article, soup_page):
+def get_published_at_value(published_at_dt_object, article, last_build_date):
     published_at_value = ""
     published_at_source = ""
     dt_object = published_at_dt_object
@@ -205,9 +272,9 @@ def get_published_at_value(published_at_dt_object, article, soup_page):
         )
         source = "meta_data -> modified_time"
 
-    elif soup_page.lastBuildDate:
-        dt_object = convert_date_to_datetime_object(soup_page.lastBuildDate.text)
-        source = "soup_page -> lastBuildDate"
+    elif last_build_date:
+        dt_object = convert_date_to_datetime_object(last_build_date)
+        source = "seed page -> lastBuildDate"
 
     else:
         # Worst case: put current date and tmie
@@ -217,23 +284,24 @@ def get_published_at_value(published_at_dt_object, article, soup_page):
         dt_object = datetime.utcnow()
         source = "None, using current time."
 
-    published_at_log_msg = "Found publishedAt in: {} with unix timestamp value: {} | Current unix timestamp: {} | Is timestamp > current timestamp: {}"
+    published_at_log_msg = "Found publishedAt in: %s with unix timestamp value: %s | Current unix timestamp: %s | Is timestamp > current timestamp: %s"
     unix_extracted = datetime.timestamp(dt_object)
     unix_now = datetime.timestamp(datetime.utcnow())
     if unix_extracted < unix_now:
         logging.debug(
-            published_at_log_msg.format(
-                source, unix_extracted, unix_now, unix_extracted > unix_now,
-            )
+            published_at_log_msg,
+            source,
+            unix_extracted,
+            unix_now,
+            unix_extracted > unix_now,
         )
     else:
         logging.warning(
-            published_at_log_msg.format(
-                "meta_data -> modified_time",
-                unix_extracted,
-                unix_now,
-                unix_extracted > unix_now,
-            )
+            published_at_log_msg,
+            "meta_data -> modified_time",
+            unix_extracted,
+            unix_now,
+            unix_extracted > unix_now,
         )
 
     # reset if extracted time is greater than current time
@@ -262,19 +330,71 @@ def get_author_value(author_default_value, article):
     else:
         source = "author not found."
 
-    logging.debug("Found author in: {} ".format(source))
+    logging.debug("Found author in: %s ", source)
     return author_value
 
 
+def get_domain_lock(netloc):
+    return DOMAIN_LOCKS.setdefault(netloc, threading.Lock())
+
+
+def get_robots_parser(scheme, netloc):
+    with get_domain_lock(netloc):
+        if netloc in ROBOTS_PARSERS:
+            return ROBOTS_PARSERS[netloc]
+
+        robots_url = "{}://{}/robots.txt".format(scheme, netloc)
+        robots_parser = RobotFileParser(robots_url)
+        try:
+            res = SESSION.get(robots_url, timeout=REQUEST_TIMEOUT)
+            # 401/403 and other 4xx follow RobotFileParser.read(), but unlike
+            # read() (which disallows everything), a 5xx or a failed request
+            # fails open so a robots.txt outage doesn't stop the crawl
+            if res.status_code in (401, 403):
+                robots_parser.disallow_all = True
+            elif res.status_code >= 400:
+                robots_parser.allow_all = True
+            else:
+                robots_parser.parse(res.text.splitlines())
+        except Exception as e:
+            logging.debug("Fail to get %s. Error: %s", robots_url, e)
+            robots_parser.allow_all = True
+
+        ROBOTS_PARSERS[netloc] = robots_parser
+        return robots_parser
+
+
+def wait_for_domain(netloc):
+    # space out requests to the same domain to avoid getting 403/429
+    with get_domain_lock(netloc):
+        last_hit = LAST_DOMAIN_HIT.get(netloc)
+        if last_hit is not None:
+            elapsed = time.monotonic() - last_hit
+            if elapsed < DOMAIN_CRAWL_DELAY:
+                time.sleep(DOMAIN_CRAWL_DELAY - elapsed)
+        LAST_DOMAIN_HIT[netloc] = time.monotonic()
+
+
 def extract_article(link):
-    logging.debug("Extracting from: {}".format(link))
+    logging.debug("Extracting from: %s", link)
     try:
+        split_url = urlsplit(link)
+        robots_parser = get_robots_parser(split_url.scheme, split_url.netloc)
+        if not robots_parser.can_fetch(HEADER["User-Agent"], link):
+            logging.debug("Disallowed by robots.txt: %s", link)
+            return None, False
+        wait_for_domain(split_url.netloc)
+
         article = Article(link, headers=HEADER)
-        # Do some NLP
-        article.download()  # Downloads the link's HTML content
+        # Download through the shared session instead of newspaper's own requests
+        res = SESSION.get(link, timeout=REQUEST_TIMEOUT)
+        res.raise_for_status()
+        # same as newspaper's downloader: without a charset in the header,
+        # pass bytes so newspaper decodes using the page's <meta charset>
+        html = res.text if get_header_charset(res) else res.content
+        article.download(input_html=html)
         article.parse()  # Parse the article
-        article.nlp()  # Keyword extraction wrapper
     except Exception as e:
-        logging.error("Fail to extract Article. Error: {}".format(e))
+        logging.error("Fail to extract Article. Error: %s", e)
         return None, False
     return article, True
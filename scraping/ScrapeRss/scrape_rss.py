@@ -20,8 +20,11 @@
 # python ScrapeRss/scrape_rss.py  -c -d
 #   -d : debug mode, write to output.jsonl, else, write to db. default=True
 #   -c : clear cache, default=False
+#   -v : verbose, write debug messages to the log file, default=False
 #   -a : get all, skip cache. api uses this to crawl everything
 #        - update database doesn't use this, to prevent duplicated entries
+#   -f : full article, download every article for content and image,
+#        else articles with title, description and date in the seed page are skipped
 #
 # Example:
 #   - write to db with log messages, doesn't update ./data/<lang>/output.jsonl
@@ -46,22 +49,20 @@ CURRENT_DIR = os.path.dirname(
 )
 sys.path.append(os.path.normpath(os.path.join(CURRENT_DIR, PARENT_DIR)))
 
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED
+from concurrent.futures import as_completed, wait
 from datetime import datetime
 from dateutil.parser import parse
+from io import BytesIO
 import threading
 import argparse
+import atexit
 import logging
 import json
-import re
-
-# nltk updates
-import nltk
-
-nltk.download("punkt")
 
 # # Global
-RSS_STACK = {}
-CACHE = set()
+CACHE_LOCK = threading.Lock()
+CACHE_FH = None
 
 # Database configurations
 from DatabaseConnector.db_connector import DatabaseConnector
@@ -77,6 +78,9 @@ db_connector_prodv2.connect()
 # import all news sources
 from ScrapeRss.rss_sites import NEWS_SOURCES
 
+# one list per locale up front, workers only ever append
+RSS_STACK = {locale: [] for locale in NEWS_SOURCES}
+
 # NewsParser
 from ScrapeRss.NewsParser import NewsParser
 
@@ -84,14 +88,15 @@ from ScrapeRss.NewsParser import NewsParser
 from ScrapeRss.NewsContent import NewsContent
 
 # Constant values
-from ScrapeRss.globals import CACHE_FILE, OUTPUT_FILENAME
-from ScrapeRss.globals import HEADER, THREAD_LIMIT
+from ScrapeRss.globals import CACHE_FILE, CACHE_BUFFER_SIZE, OUTPUT_FILENAME
+from ScrapeRss.globals import HEADER, THREAD_LIMIT, EXTRACT_THREAD_LIMIT
 from ScrapeRss.globals import DATE_FORMAT, CORONA_KEYWORDS, SPECIAL_LANG
-from ScrapeRss.globals import SEED_QUEUE, EXTRACT_QUEUE
+from ScrapeRss.globals import CACHE
 
 # Helper functions
 from ScrapeRss.helpers import (
     get_seed_page,
+    get_response_encoding,
     get_title_from_article,
     get_published_at_value,
     get_author_value,
@@ -100,17 +105,19 @@ from ScrapeRss.helpers import (
     attempt_extract_from_meta_data,
     corona_keyword_exists_in_string,
     extract_article,
+    get_site_name,
+    get_source_url,
 )
 
 global READ_ALL_SKIP_CACHE
+global FULL_ARTICLE
 
 # LOGGER CONFIG
-if not os.path.isdir("logs"):
-    os.mkdir("logs")
+os.makedirs("logs", exist_ok=True)
 
 # https://docs.python.org/3/howto/logging-cookbook.html
 logging.basicConfig(
-    level=logging.DEBUG,
+    level=logging.INFO,
     format="%(asctime)s %(name)-12s %(lineno)-8s %(levelname)-8s %(message)s",
     datefmt="%Y-%m-%d-%H-%M-%S",
     filename="./logs/scraper-rss-{}.log".format(
@@ -125,60 +132,105 @@ console.setFormatter(formatter)
 logging.getLogger("").addHandler(console)
 
 
-def seed_worker():
-    while True:
-        seed_object = SEED_QUEUE.get()
-        if seed_object is None:
-            break
-
-        root_url = seed_object.root_url
-
-        try:
-            seed_object.validate_required_values()
-            res = get_seed_page(root_url)
-        except Exception as e:
-            logging.error(e)
-            SEED_QUEUE.task_done()
-            continue
+def process_seed(seed_object):
+    seed_object.validate_required_values()
 
-        page_content = res.content
-        seed_object.parse_seed_page_content(page_content)
-        seed_object.add_news_to_extraction_queue()
-        SEED_QUEUE.task_done()
+    if not seed_object.is_xml:
+        # html needs the whole body to work out its charset
+        res = get_seed_page(seed_object.root_url)
+        seed_object.parse_seed_page_content(
+            BytesIO(res.content), get_response_encoding(res)
+        )
+        return seed_object.seed_list, seed_object.news_list
+
+    # xml declares its own encoding, parse while the page is still downloading
+    res = get_seed_page(seed_object.root_url, stream=True)
+    try:
+        seed_object.parse_seed_page_content(res.raw)
+    except Exception:
+        # connection state is unknown, close it instead of reusing it
+        res.close()
+        raise
+
+    # the parser read res.raw directly, so requests doesn't know the body is done.
+    # read whatever is left and hand the connection back to the session's pool
+    res.raw.read()
+    res.raw.release_conn()
+    return seed_object.seed_list, seed_object.news_list
+
+
+def crawl(seed_objects):
+    # seeds and articles run in separate pools, articles are submitted as soon
+    # as their seed is parsed instead of waiting for every seed to finish
+    seed_pool = ThreadPoolExecutor(max_workers=THREAD_LIMIT)
+    extract_pool = ThreadPoolExecutor(max_workers=EXTRACT_THREAD_LIMIT)
+    with seed_pool, extract_pool:
+        seed_futures = {
+            seed_pool.submit(process_seed, seed_object): seed_object
+            for seed_object in seed_objects
+        }
+        extract_futures = {}
+
+        while seed_futures:
+            done, _ = wait(seed_futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                seed_object = seed_futures.pop(future)
+                try:
+                    seed_list, news_list = future.result()
+                except Exception as e:
+                    logging.error(
+                        "Fail to process seed: %s. Error: %s", seed_object.root_url, e
+                    )
+                    continue
+
+                # sub sitemaps found in the seed page
+                for sub_seed_object in seed_list:
+                    sub_future = seed_pool.submit(process_seed, sub_seed_object)
+                    seed_futures[sub_future] = sub_seed_object
+                for news_object in news_list:
+                    news_future = extract_pool.submit(process_news, news_object)
+                    extract_futures[news_future] = news_object
 
+        logging.debug(
+            "Done extracting all root urls. Approximately %s work to crunch.",
+            len(extract_futures),
+        )
 
-def extract_worker():
-    while True:
-        approx_queue_size = EXTRACT_QUEUE.qsize()
-        if approx_queue_size % 10 == 0:
-            logging.debug(
-                "===> Approximately {} item(s) in the queue ...".format(
-                    approx_queue_size
+        for count, future in enumerate(as_completed(extract_futures), start=1):
+            approx_queue_size = len(extract_futures) - count
+            if approx_queue_size % 10 == 0:
+                logging.debug(
+                    "===> Approximately %s item(s) in the queue ...", approx_queue_size
+                )
+            try:
+                future.result()
+            except Exception as e:
+                logging.error(
+                    "Fail to process news: %s. Error: %s",
+                    extract_futures[future].news_url,
+                    e,
                 )
-            )
-
-        news_object = EXTRACT_QUEUE.get()
-
-        if news_object is None:
-            break
 
-        rss_record = {}
-        rss_record["url"] = news_object.news_url
 
-        # early catching, capture cached url or blacklist keywords. eg: "/archives/"
-        if rss_record["url"] in CACHE:
-            EXTRACT_QUEUE.task_done()
-            continue
+def process_news(news_object):
+    rss_record = {}
+    rss_record["url"] = news_object.news_url
 
-        if not READ_ALL_SKIP_CACHE:
-            write_to_cache(rss_record["url"])
-        CACHE.add(rss_record["url"])
+    # early catching, capture cached url or blacklist keywords. eg: "/archives/"
+    if not claim_url(rss_record["url"]):
+        return
 
+    if not FULL_ARTICLE and news_object.has_feed_data():
+        # seed page already has title, description and publish date,
+        # skip downloading and parsing the article
+        article = None
+        rss_record["description"] = news_object.description
+        rss_record["title"] = news_object.title
+    else:
         # Process article
         article, status = extract_article(rss_record["url"])
         if not status:
-            EXTRACT_QUEUE.task_done()
-            continue
+            return
 
         # Overwrite description if exists in meta tag
         rss_record["description"] = attempt_extract_from_meta_data(
@@ -193,94 +245,106 @@ def extract_worker():
 
         # If keyword doesn't exists in article, skip
         if (
-            not corona_keyword_exists_in_string(rss_record["description"].lower())
-            and not corona_keyword_exists_in_string(rss_record["title"].lower())
-            and not corona_keyword_exists_in_string(keywords.lower())
+            not corona_keyword_exists_in_string(rss_record["description"])
+            and not corona_keyword_exists_in_string(rss_record["title"])
+            and not corona_keyword_exists_in_string(keywords)
         ):
-            EXTRACT_QUEUE.task_done()
-            continue
-
-        # Get language and country
-        locale = news_object.seed_source.locale
-        lang_locale = locale.split("_")
-        if len(lang_locale) < 2:
-            logging.error(
-                "Locale format in seed is incorrect, should be in xx_YY format. Eg: ms_MY (malay, Malaysia)."
-            )
-            EXTRACT_QUEUE.task_done()
-            continue
-
-        lang, country = lang_locale[0], lang_locale[1]
-        rss_record["language"] = (
-            lang
-            if (lang, country) not in SPECIAL_LANG
-            else SPECIAL_LANG[(lang, country)]
+            return
+
+    # Get language and country
+    locale = news_object.seed_source.locale
+    lang_locale = locale.split("_")
+    if len(lang_locale) < 2:
+        logging.error(
+            "Locale format in seed is incorrect, should be in xx_YY format. Eg: ms_MY (malay, Malaysia)."
         )
-        rss_record["countryCode"] = country
+        return
 
+    lang, country = lang_locale[0], lang_locale[1]
+    rss_record["language"] = (
+        lang if (lang, country) not in SPECIAL_LANG else SPECIAL_LANG[(lang, country)]
+    )
+    rss_record["countryCode"] = country
+
+    if article is None:
+        rss_record["siteName"] = get_site_name(get_source_url(rss_record["url"]))
+        rss_record["author"] = news_object.author
+    else:
         # Get siteName
-        rss_record["siteName"] = re.sub(r"https?://(www\.)?", "", article.source_url)
+        rss_record["siteName"] = get_site_name(article.source_url)
 
         # Get the authors
         rss_record["author"] = get_author_value(news_object.author, article)
 
-        # Get the publish date
-        rss_record["publishedAt"] = get_published_at_value(
-            news_object.published_at, article, news_object.seed_source.soup_page
-        )
+    # Get the publish date
+    rss_record["publishedAt"] = get_published_at_value(
+        news_object.published_at, article, news_object.seed_source.last_build_date
+    )
 
-        # Set addedOn after publish date
-        rss_record["addedOn"] = datetime.utcnow().strftime(DATE_FORMAT)
+    # Set addedOn after publish date
+    rss_record["addedOn"] = datetime.utcnow().strftime(DATE_FORMAT)
 
+    if article is None:
+        rss_record["content"] = rss_record["description"]
+        rss_record["urlToImage"] = ""
+    else:
         rss_record["content"] = (
             article.text if article.text else rss_record["description"]
         )
         # Get the top image
         rss_record["urlToImage"] = article.top_image
 
-        if locale not in RSS_STACK:
-            RSS_STACK[locale] = []
-        RSS_STACK[locale].append(rss_record)
+    RSS_STACK[locale].append(rss_record)
 
-        EXTRACT_QUEUE.task_done()
+
+def format_record(rss_record):
+    to_print = ""
+    to_print += "\ntitle:\t" + rss_record["title"]
+    to_print += "\ndescription:\t" + rss_record["description"]
+    to_print += "\nurl:\t" + rss_record["url"]
+    to_print += "\npublishedAt:\t" + rss_record["publishedAt"]
+    to_print += "\naddedOn:\t" + rss_record["addedOn"]
+    to_print += "\nauthor:\t" + rss_record["author"]
+    to_print += "\ncontent:\n" + rss_record["content"]
+    to_print += "\nurlToImage:\t" + rss_record["urlToImage"]
+    to_print += "\nlanguage:\t" + rss_record["language"]
+    to_print += "\ncountryCode:\t" + rss_record["countryCode"]
+    to_print += "\nsiteName:\t" + rss_record["siteName"]
+    return to_print.expandtabs()
 
 
 def print_pretty():
-    for locale, rss_records in RSS_STACK.items():
-        for rss_record in rss_records:
-            to_print = ""
-            to_print += "\ntitle:\t" + rss_record["title"]
-            to_print += "\ndescription:\t" + rss_record["description"]
-            to_print += "\nurl:\t" + rss_record["url"]
-            to_print += "\npublishedAt:\t" + rss_record["publishedAt"]
-            to_print += "\naddedOn:\t" + rss_record["addedOn"]
-            to_print += "\nauthor:\t" + rss_record["author"]
-            to_print += "\ncontent:\n" + rss_record["content"]
-            to_print += "\nurlToImage:\t" + rss_record["urlToImage"]
-            to_print += "\nlanguage:\t" + rss_record["language"]
-            to_print += "\ncountryCode:\t" + rss_record["countryCode"]
-            to_print += "\nsiteName:\t" + rss_record["siteName"]
-            to_print += ""
+    to_print = [
+        format_record(rss_record)
+        for rss_records in RSS_STACK.values()
+        for rss_record in rss_records
+    ]
+    # one write for the whole report, fall back to printing per record
+    # so a single unprintable record doesn't lose the rest
+    try:
+        sys.stdout.write("\n".join(to_print) + "\n")
+    except:
+        for record in to_print:
             try:
-                print(to_print.expandtabs())
+                print(record)
             except:
                 pass
 
 
 def write_output():
     for locale, rss_records in RSS_STACK.items():
+        if not rss_records:
+            continue
+        lines = [json.dumps(rss_record) + "\n" for rss_record in rss_records]
         with open("data/{}/{}".format(locale, OUTPUT_FILENAME), "w") as fh:
-            for rss_record in rss_records:
-                json.dump(rss_record, fh)
-                fh.write("\n")
+            fh.write("".join(lines))
 
 
 def save_to_db(table_name):
-    logging.debug("Saving to db to {} table".format(table_name))
+    logging.debug("Saving to db to %s table", table_name)
     for locale, rss_records in RSS_STACK.items():
-        for rss_record in rss_records:
-            db_connector.insert_news_article(rss_record, table_name)
-            db_connector_prodv2.insert_news_article(rss_record, table_name)
+        db_connector.insert_news_articles(rss_records, table_name)
+        db_connector_prodv2.insert_news_articles(rss_records, table_name)
 
 
 def parser():
@@ -296,97 +360,97 @@ def parser():
     parser.add_argument(
         "-a", "--all", action="store_true", help="Skip read and write on cache"
     )
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", help="Write debug log messages"
+    )
+    parser.add_argument(
+        "-f",
+        "--full-article",
+        action="store_true",
+        help="Always download articles, even if the seed page has all the data",
+    )
     return parser.parse_args()
 
 
 def read_cache():
     with open(CACHE_FILE, "r") as fh:
-        stream = fh.read()
-        for row in stream.split("\n"):
-            CACHE.add(row)
+        CACHE.update(row.rstrip("\n") for row in fh)
+
+
+def open_cache():
+    # keep one buffered handle for the whole run, flushed on exit
+    global CACHE_FH
+    CACHE_FH = open(CACHE_FILE, "a", buffering=CACHE_BUFFER_SIZE)
+    atexit.register(CACHE_FH.close)
 
 
 def write_to_cache(url):
-    with open(CACHE_FILE, "a+") as fh:
-        fh.write(url + "\n")
+    with CACHE_LOCK:
+        CACHE_FH.write(url + "\n")
+
+
+def claim_url(url):
+    # check and add under the lock, so two workers can't both pick up the same url
+    with CACHE_LOCK:
+        if url in CACHE:
+            return False
+        CACHE.add(url)
+
+    if not READ_ALL_SKIP_CACHE:
+        write_to_cache(url)
+    return True
 
 
 if __name__ == "__main__":
     # arguments
     args = parser()
 
+    # debug messages are only formatted and written to the log file with -v
+    if args.verbose:
+        logging.getLogger("").setLevel(logging.DEBUG)
+
     READ_ALL_SKIP_CACHE = args.all
+    FULL_ARTICLE = args.full_article
     debug_mode = args.debug
     database_table_name = args.table
 
     # create required folders
-    if not os.path.isdir("data"):
-        logging.debug("Creating ./data directory")
-        os.mkdir("./data")
+    os.makedirs("./data", exist_ok=True)
 
     # reset cache
     if args.clear:
-        logging.debug("Clearing cache file {}".format(CACHE_FILE))
-        os.system("rm {}".format(CACHE_FILE))
+        logging.debug("Clearing cache file %s", CACHE_FILE)
+        try:
+            os.unlink(CACHE_FILE)
+        except FileNotFoundError:
+            pass
 
-    # check cache file exists
-    if not os.path.isfile(CACHE_FILE):
-        logging.debug("Creating cache file {}".format(CACHE_FILE))
-        os.system("touch {}".format(CACHE_FILE))
+    # create cache file if it doesn't exist
+    open(CACHE_FILE, "a").close()
 
     # if set READ_ALL_SKIP_CACHE, skip reading cache
     if not READ_ALL_SKIP_CACHE:
         logging.debug("Reading cache file...")
         read_cache()
+        open_cache()
 
-    # initialize threads
-    THREADS = []
-
-    # extract all xml data
-    for i in range(THREAD_LIMIT):
-        t = threading.Thread(target=seed_worker)
-        t.start()
-        THREADS.append(t)
-
-    # place initial seed urls to seed queue to process
+    # initial seed urls to process
+    seed_objects = []
     for locale, list_url_schema in NEWS_SOURCES.items():
         logging.debug(
-            "locale: {}, Number of websites: {}".format(locale, len(list_url_schema))
+            "locale: %s, Number of websites: %s", locale, len(list_url_schema)
         )
-        if not os.path.isdir("./data/{}".format(locale)):
-            os.mkdir("./data/{}".format(locale))
+        os.makedirs("./data/{}".format(locale), exist_ok=True)
         for url_schema in list_url_schema:
             url, schema = url_schema
-            logging.debug(
-                "Adding seed url to queue: {}. Schema: {}".format(url, schema)
-            )
-            seed_object = NewsParser(locale=locale, root_url=url, schema=schema)
-            SEED_QUEUE.put(seed_object)
-
-    # end seed workers
-    SEED_QUEUE.join()
-    for i in range(len(THREADS)):
-        SEED_QUEUE.put(None)
-
-    logging.debug(
-        "Done extracting all root urls. Approximately {} work to crunch.".format(
-            EXTRACT_QUEUE.qsize()
-        )
-    )
-
-    # process extracted urls
-    for i in range(len(THREADS)):
-        THREADS[i] = threading.Thread(target=extract_worker)
-        THREADS[i].start()
+            logging.debug("Adding seed url to queue: %s. Schema: %s", url, schema)
+            seed_objects.append(NewsParser(locale=locale, root_url=url, schema=schema))
 
-    # end extract workers
-    EXTRACT_QUEUE.join()
-    for i in range(len(THREADS)):
-        EXTRACT_QUEUE.put(None)
+    crawl(seed_objects)
 
     logging.debug("Done extracting all feed data")
 
-    if not RSS_STACK:
+    if not any(RSS_STACK.values()):
         logging.debug("RSS Stack is empty. Exiting...")
         exit()
 
@@ -401,5 +465,5 @@ if __name__ == "__main__":
     count = 0
     for lang, rss_records in RSS_STACK.items():
         count += len(rss_records)
-    logging.debug("Total feeds: {}".format(count))
+    logging.debug("Total feeds: %s", count)
     logging.debug("Done scraping.")